@@ -3,14 +3,18 @@ Improved search_api.py
 Features:
 - Semantic search using ChromaDB
 - Optional filters (patient name, doctor, gender, date)
-- Normalized similarity scores
+- Cosine similarity scores
 - Clean, structuresearch_api:app --reload --port 8000d JSON response
 - Returns diagnosis, prescriptions, cleaned_text
 """
 
+from functools import lru_cache
+
 from fastapi import FastAPI, Query
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 import chromadb
+from sentence_transformers import SentenceTransformer
 
 app = FastAPI(title="Medical Note Search API")
 
@@ -26,31 +30,84 @@ app.add_middleware(
 client = chromadb.PersistentClient(path="chroma_db")
 collection = client.get_collection(name="medical_notes")
 
+# Query embedder, loaded once and kept warm for every request
+EMBED = SentenceTransformer("all-MiniLM-L6-v2")
+EMBED.max_seq_length = 256
+
+
 # -----------------------------
-# Utility: normalize score
+# Utility: embed query
 # -----------------------------
-def normalize(distance: float):
-    """Convert Euclidean distance into similarity score (0–1)."""
-    return round(1 / (1 + distance), 4)
+@lru_cache(maxsize=1024)
+def embed_query(q: str):
+    """Encode a query the same way chroma_index.py encodes the notes."""
+    return EMBED.encode([q], normalize_embeddings=True)[0].tolist()
+
+
+# -----------------------------
+# Startup: warm model + index
+# -----------------------------
+@app.on_event("startup")
+async def warm():
+    """Pay the first encode + HNSW load before the first real request."""
+    try:
+        warm_embedding = EMBED.encode(["warmup"], normalize_embeddings=True).tolist()
+        collection.query(query_embeddings=warm_embedding, n_results=1)
+    except Exception:
+        pass
+
+
+# -----------------------------
+# Utility: build Chroma metadata filter
+# -----------------------------
+def build_where(patient: list[str] | None, doctor: list[str] | None, gender: str | None):
+    """Translate optional filters into a Chroma `where` clause (or None)."""
+
+    def match_any(field: str, values: list[str] | None):
+        values = [v.strip().lower() for v in values or [] if v.strip()]
+        if not values:
+            return None
+        if len(values) == 1:
+            return {field: {"$eq": values[0]}}
+        return {field: {"$in": values}}
+
+    conditions = [
+        c for c in (
+            match_any("patient_name_lc", patient),
+            match_any("doctor_lc", doctor),
+            match_any("gender_lc", [gender] if gender else None),
+        )
+        if c
+    ]
+
+    if not conditions:
+        return None
+    if len(conditions) == 1:
+        return conditions[0]
+    return {"$and": conditions}
 
 
 # -----------------------------
 # Search Endpoint
 # -----------------------------
 @app.get("/search")
-def search_medical_notes(
+async def search_medical_notes(
     q: str = Query(..., description="Search query"),
     top_k: int = Query(5, ge=1, le=20),
-    patient: str | None = None,
-    doctor: str | None = None,
-    gender: str | None = None,
+    patient: list[str] | None = Query(None, description="Exact patient name(s), repeat to match any (case-insensitive)"),
+    doctor: list[str] | None = Query(None, description="Exact doctor name(s), repeat to match any (case-insensitive)"),
+    gender: str | None = Query(None, description="Patient gender (case-insensitive)"),
 ):
     """Semantic search over indexed medical notes."""
 
+    # Embedding + Chroma search block, so keep them off the event loop
     try:
-        results = collection.query(
-            query_texts=[q],
+        query_embedding = await run_in_threadpool(embed_query, q)
+        results = await run_in_threadpool(
+            collection.query,
+            query_embeddings=[query_embedding],
             n_results=top_k,
+            where=build_where(patient, doctor, gender),
             include=["metadatas", "documents", "distances"],
         )
     except Exception as e:
@@ -60,7 +117,7 @@ def search_medical_notes(
     for idx, meta in enumerate(results["metadatas"][0]):
         doc_info = {
             "id": results["ids"][0][idx],
-            "similarity": normalize(results["distances"][0][idx]),
+            "similarity": round(1 - results["distances"][0][idx], 4),  # cosine
             "text": results["documents"][0][idx],
             "metadata": {
                 "patient": {
@@ -76,18 +133,6 @@ def search_medical_notes(
 
         docs.append(doc_info)
 
-    # -----------------------------
-    # Apply optional filters
-    # -----------------------------
-    if patient:
-        docs = [d for d in docs if d["metadata"]["patient"]["name"] and patient.lower() in d["metadata"]["patient"]["name"].lower()]
-
-    if doctor:
-        docs = [d for d in docs if d["metadata"]["doctor"] and doctor.lower() in d["metadata"]["doctor"].lower()]
-
-    if gender:
-        docs = [d for d in docs if d["metadata"]["patient"]["gender"] and d["metadata"]["patient"]["gender"].lower() == gender.lower()]
-
     return {
         "query": q,
         "count": len(docs),
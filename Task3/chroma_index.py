@@ -8,67 +8,120 @@ This version:
 """
 
 import os
-import json
 import glob
 from pathlib import Path
 import re
+import threading
+from collections import Counter
+import orjson
+import pandas as pd
 import chromadb
-from chromadb.utils import embedding_functions
+from sentence_transformers import SentenceTransformer
 import argparse
 
 
 # ==========================================
 # 1. Canonical prescription
 # ==========================================
-def canonicalize_prescription(p):
-    """Turn each prescription entry into stable canonical format"""
-    drug = (p.get("drug") or "").lower().strip()
-    dose = (p.get("dose") or "").lower().strip()
-    freq = (p.get("frequency") or "").lower().strip()
-
-    # Normalize spacing
-    drug = re.sub(r"\s+", " ", drug)
-    dose = re.sub(r"\s+", " ", dose)
-    freq = re.sub(r"\s+", " ", freq)
+_WS = re.compile(r"\s+")
+_IV = re.compile(r"i\.?v\.?")
+_MG = re.compile(r"(\d+)\s*mg")
+
+
+def canonicalize_prescriptions(rows):
+    """
+    Canonicalize every prescription row at once with pandas string kernels.
+    rows: [{"doc_id", "drug", "dose", "frequency"}, ...]
+    Returns {doc_id: "sorted | joined | canonical treatments"}
+    """
+    if not rows:
+        return {}
+
+    df = pd.DataFrame(rows, columns=["doc_id", "drug", "dose", "frequency"])
+    drug, dose, freq = (
+        df[col].fillna("").astype(str).str.lower().str.strip()
+        for col in ("drug", "dose", "frequency")
+    )
 
     # Normalize IV
-    dose = re.sub(r"i\.?v\.?", "iv", dose)
-    freq = re.sub(r"i\.?v\.?", "iv", freq)
+    dose = dose.str.replace(_IV, "iv", regex=True)
+    freq = freq.str.replace(_IV, "iv", regex=True)
 
     # Normalize mg
-    dose = re.sub(r"(\d+)\s*mg", r"\1mg", dose)
+    dose = dose.str.replace(_MG, r"\1mg", regex=True)
 
-    # Build final canonical string
-    final = f"{drug} {dose} {freq}".strip()
-    final = re.sub(r"\s+", " ", final)  # compress spaces
+    # Build final canonical strings, normalizing spacing in one pass
+    df["canonical"] = (drug + " " + dose + " " + freq).str.replace(_WS, " ", regex=True).str.strip()
+    df = df[df["canonical"] != ""]
 
-    return final
+    # Sort so duplicates produce identical strings, then join per document
+    return df.groupby("doc_id")["canonical"].agg(lambda c: " | ".join(sorted(c))).to_dict()
 
 
 # ==========================================
-# 2. Initialize Chroma
+# 2. Embedding model + Chroma
 # ==========================================
-client = chromadb.PersistentClient(path="chroma_db")
+EMBED_MODEL_NAME = "all-MiniLM-L6-v2"
+EMBED_BATCH_SIZE = 256
+
+_EMBEDDER = None
+
+
+def get_embedder():
+    """Load the SentenceTransformer once (picks CUDA automatically if present)"""
+    global _EMBEDDER
+    if _EMBEDDER is None:
+        _EMBEDDER = SentenceTransformer(EMBED_MODEL_NAME)
+    return _EMBEDDER
+
+
+def embed_texts(texts, show_progress_bar=False):
+    """Encode texts into unit-length float32 vectors in large batches"""
+    # Kept as float32: Chroma's HNSW stores every vector as float32, so int8 /
+    # fp16 quantized embeddings would be upcast on add() and save nothing.
+    return get_embedder().encode(
+        texts,
+        batch_size=EMBED_BATCH_SIZE,
+        convert_to_numpy=True,
+        normalize_embeddings=True,
+        show_progress_bar=show_progress_bar,
+    )
+
+
+CHROMA_DB_PATH = "chroma_db"
+
+client = chromadb.PersistentClient(path=CHROMA_DB_PATH)
 
+# Embeddings are computed above and passed in explicitly,
+# so Chroma does not need its own embedding function.
+# Vectors are unit-length, so cosine distance → similarity is just 1 - d.
+# M / construction_ef are pinned at Chroma's defaults (lower them only after
+# a recall@10 check); search_ef is raised from the default 10 to 50, trading
+# a little query latency for recall on filter-heavy `where` searches.
 collection = client.get_or_create_collection(
     name="medical_notes",
-    embedding_function=embedding_functions.SentenceTransformerEmbeddingFunction(
-        model_name="all-MiniLM-L6-v2"
-    )
+    embedding_function=None,
+    metadata={
+        "hnsw:space": "cosine",
+        "hnsw:M": 16,
+        "hnsw:construction_ef": 100,
+        "hnsw:search_ef": 50,
+    },
 )
 
 
 # ==========================================
 # 3. Load structured JSON files
 # ==========================================
-def load_parsed_files(folder="outputs/clean"):
-    files = sorted(glob.glob(os.path.join(folder, "*.json")))
-    items = []
+def load_parsed_files(files):
+    parsed = []
+    rows = []
 
     for f in files:
         try:
-            data = json.load(open(f, "r", encoding="utf8"))
-        except:
+            with open(f, "rb") as fh:
+                data = orjson.loads(fh.read())
+        except (OSError, orjson.JSONDecodeError):
             print(f"⚠ Skipping unreadable JSON: {f}")
             continue
 
@@ -79,28 +132,27 @@ def load_parsed_files(folder="outputs/clean"):
             print(f"⚠ Skipping {f} — no text found")
             continue
 
-        patient = data.get("patient", {})
+        parsed.append((f, doc_id, text, data))
 
         # --------------------------
-        # Canonical treatments LIST
+        # Flatten prescriptions → one row each
         # --------------------------
-        canonical_list = []
-        for p in data.get("prescriptions", []):
-            c = canonicalize_prescription(p)
-            if c:
-                canonical_list.append(c)
+        for p in data.get("prescriptions") or []:
+            rows.append({
+                "doc_id": doc_id,
+                "drug": p.get("drug"),
+                "dose": p.get("dose"),
+                "frequency": p.get("frequency"),
+            })
+
+    # --------------------------
+    # Canonical treatments STRING per doc (one vectorized pass)
+    # --------------------------
+    treatments_by_doc = canonicalize_prescriptions(rows)
 
-        # --------------------------
-        # Convert LIST → stable STRING for Chroma
-        # --------------------------
-        if canonical_list:
-            # Sort so duplicates produce identical strings
-            canonical_list = sorted(canonical_list)
-
-            # One stable canonical string:
-            final_treatments = " | ".join(canonical_list)
-        else:
-            final_treatments = ""
+    items = []
+    for f, doc_id, text, data in parsed:
+        patient = data.get("patient", {})
 
         # --------------------------
         # Metadata (All must be strings)
@@ -113,7 +165,11 @@ def load_parsed_files(folder="outputs/clean"):
             "doctor": data.get("doctor") or "",
             "hospital": data.get("hospital") or "",
             "diagnosis": data.get("diagnosis") or "",
-            "treatments": final_treatments,   # ALWAYS a canonical string ✔
+            "treatments": treatments_by_doc.get(doc_id, ""),   # ALWAYS a canonical string ✔
+            # Lowercased copies so search filters run inside Chroma's `where`
+            "patient_name_lc": (patient.get("name") or "").strip().lower(),
+            "doctor_lc": (data.get("doctor") or "").strip().lower(),
+            "gender_lc": (patient.get("gender") or "").strip().lower(),
         }
 
         items.append((doc_id, text, metadata))
@@ -125,34 +181,126 @@ def load_parsed_files(folder="outputs/clean"):
 # ==========================================
 # 4. Index into Chroma
 # ==========================================
-def index_all(folder="outputs/clean", batch=32):
-    items = load_parsed_files(folder)
+TREATMENT_COUNTS_PATH = os.path.join(CHROMA_DB_PATH, "treatment_counts.json")
+
+
+def load_treatment_counts():
+    """Sidecar kept next to Chroma: per-doc treatment lists + global counts"""
+    try:
+        with open(TREATMENT_COUNTS_PATH, "rb") as fh:
+            return orjson.loads(fh.read())
+    except (OSError, orjson.JSONDecodeError):
+        return {"docs": {}, "counts": {}}
+
+
+def _split_treatments(joined):
+    return [t for t in (joined or "").split(" | ") if t]
+
+
+# Serializes the sidecar read-modify-write (concurrent /upload threads)
+_COUNTS_LOCK = threading.Lock()
+
+
+def _seed_treatment_docs():
+    # Sidecar missing or out of step with the index (e.g. a chroma_db built
+    # before it existed) → rebuild from every note's metadata
+    res = collection.get(include=["metadatas"])
+    return {
+        doc_id: _split_treatments((meta or {}).get("treatments"))
+        for doc_id, meta in zip(res["ids"], res["metadatas"])
+    }
+
+
+def _write_treatment_counts(docs):
+    # counts ordered by (-count, treatment) → ties always break alphabetically
+    counts = Counter(t for treatments in docs.values() for t in treatments)
+    data = {
+        "docs": docs,
+        "counts": dict(sorted(counts.items(), key=lambda tn: (-tn[1], tn[0]))),
+    }
+
+    # Write aside then swap in, so readers never see a half-written file
+    tmp_path = f"{TREATMENT_COUNTS_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as fh:
+        fh.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+    os.replace(tmp_path, TREATMENT_COUNTS_PATH)
+    return data
+
+
+def _update_treatment_counts(items):
+    with _COUNTS_LOCK:
+        docs = load_treatment_counts()["docs"]
+
+        # Re-indexed docs replace their old entry instead of adding to it
+        for doc_id, _, meta in items:
+            docs[doc_id] = _split_treatments(meta["treatments"])
+
+        if len(docs) != collection.count():
+            docs = _seed_treatment_docs()
+        _write_treatment_counts(docs)
+
+
+def current_treatment_counts():
+    """Sidecar contents, reseeded first if they don't cover the whole index"""
+    with _COUNTS_LOCK:
+        data = load_treatment_counts()
+        if len(data["docs"]) != collection.count():
+            data = _write_treatment_counts(_seed_treatment_docs())
+        return data
+
+
+def _index_items(items, batch=128):
+    # Never exceed what the Chroma backend accepts in one upsert()
+    batch = min(batch, client.get_max_batch_size())
+
+    # Similar-length texts in a batch → less padding in the MiniLM forward pass
+    items = sorted(items, key=lambda item: len(item[1]))
+
+    # One encode call for all items instead of one per upsert()
+    embeddings = embed_texts([text for _, text, _ in items], show_progress_bar=len(items) > 1)
+
+    # upsert (not add) so re-indexing an existing note replaces it
+    for start in range(0, len(items), batch):
+        chunk = items[start:start + batch]
+        collection.upsert(
+            ids=[doc_id for doc_id, _, _ in chunk],
+            documents=[text for _, text, _ in chunk],
+            metadatas=[meta for _, _, meta in chunk],
+            embeddings=embeddings[start:start + batch].tolist(),
+        )
+        print(f"Indexed batch of {len(chunk)}")
+
+    _update_treatment_counts(items)
+
+
+def index_all(folder="outputs/clean", batch=128):
+    files = sorted(glob.glob(os.path.join(folder, "*.json")))
+    items = load_parsed_files(files)
     if not items:
         print("❌ No JSON files found")
         return
 
     print(f"📂 Indexing {len(items)} files...")
+    _index_items(items, batch)
+    print("✅ Indexing complete.")
 
-    ids, docs, metas = [], [], []
-
-    for idx, (doc_id, text, meta) in enumerate(items, start=1):
-        ids.append(doc_id)
-        docs.append(text)
-        metas.append(meta)
 
-        if len(ids) == batch or idx == len(items):
-            collection.add(ids=ids, documents=docs, metadatas=metas)
-            print(f"Indexed batch of {len(ids)}")
-            ids, docs, metas = [], [], []
+def index_file(json_path):
+    """Index (or re-index) a single structured JSON file"""
+    items = load_parsed_files([json_path])
+    if not items:
+        print(f"❌ Nothing to index in {json_path}")
+        return
 
-    print("✅ Indexing complete.")
+    _index_items(items)
+    print(f"✅ Indexed {json_path}")
 
 
 # ==========================================
 # 5. Optional search test
 # ==========================================
 def query_text(q, n=5):
-    return collection.query(query_texts=[q], n_results=n)
+    return collection.query(query_embeddings=embed_texts([q]).tolist(), n_results=n)
 
 
 if __name__ == "__main__":
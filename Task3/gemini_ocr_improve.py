@@ -1,7 +1,12 @@
 import os
-import json
+import string
+import orjson
+from concurrent.futures import ThreadPoolExecutor
 import google.generativeai as genai
 
+# Concurrent Gemini requests in process_path (keep within your API rate limit)
+MAX_WORKERS = 8
+
 def setup_gemini():
     api_key = os.getenv("GEMINI_API_KEY")
     if not api_key:
@@ -9,11 +14,21 @@ def setup_gemini():
     genai.configure(api_key=api_key)
     return genai.GenerativeModel("gemini-2.5-flash")
 
+
+# Configured once and shared by every call / file
+_MODEL = None
+
+def _get_model():
+    global _MODEL
+    if _MODEL is None:
+        _MODEL = setup_gemini()
+    return _MODEL
+
 # ----------------------------------------------------
 # 1️⃣ Extract RAW TEXT from image/PDF
 # ----------------------------------------------------
 def gemini_extract_raw_text(file_path):
-    model = setup_gemini()
+    model = _get_model()
 
     with open(file_path, "rb") as f:
         bytes_data = f.read()
@@ -38,7 +53,7 @@ def gemini_extract_raw_text(file_path):
 # 2️⃣ Structured JSON (Task 1)
 # ----------------------------------------------------
 def gemini_structure(raw_text):
-    model = setup_gemini()
+    model = _get_model()
 
     prompt = f"""
     You are a medical AI. Convert the OCR text below into structured JSON.
@@ -80,6 +95,22 @@ def gemini_structure(raw_text):
     return response.text
 
 
+_FENCE_LANG_CHARS = string.ascii_letters + string.digits + "_-"
+
+
+def strip_code_fences(text):
+    """Remove a leading ```lang line and trailing ``` without running a regex"""
+    text = text.strip()
+    if text.startswith("```"):
+        if "\n" in text:
+            text = text.split("\n", 1)[1]
+        else:
+            # single-line fence like ```json{...}``` -> drop the language tag too
+            text = text[3:].lstrip(_FENCE_LANG_CHARS)
+        text = text.rsplit("```", 1)[0]
+    return text.strip()
+
+
 # ----------------------------------------------------
 # 3️⃣ Convert to Task-2 Summary JSON (Assessment Required)
 # ----------------------------------------------------
@@ -130,45 +161,53 @@ def process_path(path):
             if f.lower().endswith((".jpg", ".jpeg", ".png", ".pdf"))
         ]
 
-    for f in files:
-        base = os.path.basename(f)
-        print(f"\n🔍 Processing {base}")
-
-        # ---- RAW TEXT ----
-        raw_text = gemini_extract_raw_text(f)
-        raw_out = f"outputs/raw/{base}.txt"
-        with open(raw_out, "w", encoding="utf8") as fw:
-            fw.write(raw_text)
-        print(f"📄 Saved raw text → {raw_out}")
-
-        # ---- STRUCTURED JSON ----
-        structured = gemini_structure(raw_text)
-        import re
-        structured_clean = re.sub(r"```[a-zA-Z0-9_-]*", "", structured)
-        structured_clean = structured_clean.replace("```", "").strip()
-
-
-        try:
-            structured_dict = json.loads(structured_clean)
-            structured_dict["raw_text"] = raw_text
-        except:
-            structured_dict = {"error": "Invalid JSON", "raw": structured_clean}
-
-        json_out = f"outputs/clean/{base}.json"
-        with open(json_out, "w", encoding="utf8") as fw:
-            json.dump(structured_dict, fw, indent=2)
-        print(f"✅ Saved Task-1 structured JSON → {json_out}")
-
-        # ---- TASK 2 SUMMARY JSON ----
-        if "error" not in structured_dict:
-            summary = convert_for_task2(structured_dict)
-        else:
-            summary = {"error": "cannot convert", "source": base}
+    # Create the shared model up front so worker threads don't race on it
+    _get_model()
+
+    # Each file is two blocking Gemini calls → overlap them across threads
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        return list(ex.map(_handle_file, files))
+
+
+def _handle_file(f):
+    base = os.path.basename(f)
+    print(f"\n🔍 Processing {base}")
+
+    # ---- RAW TEXT ----
+    raw_text = gemini_extract_raw_text(f)
+    raw_out = f"outputs/raw/{base}.txt"
+    with open(raw_out, "w", encoding="utf8") as fw:
+        fw.write(raw_text)
+    print(f"📄 Saved raw text → {raw_out}")
+
+    # ---- STRUCTURED JSON ----
+    structured = gemini_structure(raw_text)
+    structured_clean = strip_code_fences(structured)
+
+
+    try:
+        structured_dict = orjson.loads(structured_clean)
+        structured_dict["raw_text"] = raw_text
+    except:
+        structured_dict = {"error": "Invalid JSON", "raw": structured_clean}
+
+    json_out = f"outputs/clean/{base}.json"
+    with open(json_out, "wb") as fw:
+        fw.write(orjson.dumps(structured_dict, option=orjson.OPT_INDENT_2))
+    print(f"✅ Saved Task-1 structured JSON → {json_out}")
+
+    # ---- TASK 2 SUMMARY JSON ----
+    if "error" not in structured_dict:
+        summary = convert_for_task2(structured_dict)
+    else:
+        summary = {"error": "cannot convert", "source": base}
+
+    summary_out = f"outputs/task2/{base}_summary.json"
+    with open(summary_out, "wb") as fw:
+        fw.write(orjson.dumps(summary, option=orjson.OPT_INDENT_2))
+    print(f"📘 Saved Task-2 summary JSON → {summary_out}")
 
-        summary_out = f"outputs/task2/{base}_summary.json"
-        with open(summary_out, "w", encoding="utf8") as fw:
-            json.dump(summary, fw, indent=2)
-        print(f"📘 Saved Task-2 summary JSON → {summary_out}")
+    return json_out
 
 
 # ----------------------------------------------------
@@ -1,19 +1,30 @@
 # rag_api.py
 import os
+import re
 import json
+import threading
+from collections import Counter
 from typing import List, Dict, Any
 from fastapi import FastAPI, HTTPException, Query
 from pydantic import BaseModel
-import chromadb
 import google.generativeai as genai
 from fastapi import UploadFile, File
+from fastapi.concurrency import run_in_threadpool
 from pathlib import Path
-import subprocess
 import signal
+
+# OCR + indexing run in-process so the embedder and Chroma handle are shared
+from gemini_ocr_improve import process_path
+from chroma_index import collection, current_treatment_counts, embed_texts, index_file
+
+# Optional: linear-time RE2 (pip install google-re2) for intent matching;
+# stdlib re otherwise
+try:
+    import re2 as intent_re
+except ImportError:
+    intent_re = re
 # ------------- Config -------------
 GEMINI_MODEL = "gemini-2.5-flash"
-CHROMA_DB_PATH = "chroma_db"
-CHROMA_COLLECTION_NAME = "medical_notes"
 
 # retrieval settings
 TOP_K = 10
@@ -32,18 +43,7 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# ------------- Setup Chroma and Gemini -------------
-client = chromadb.PersistentClient(path=CHROMA_DB_PATH)
-from chromadb.utils import embedding_functions
-
-collection = client.get_or_create_collection(
-    name=CHROMA_COLLECTION_NAME,
-    embedding_function=embedding_functions.SentenceTransformerEmbeddingFunction(
-        model_name="all-MiniLM-L6-v2"
-    )
-)
-
-
+# ------------- Setup Gemini -------------
 def setup_genai_client():
     key = os.getenv("GEMINI_API_KEY")
     if not key:
@@ -58,6 +58,16 @@ except Exception as e:
     # We'll raise on calls if not configured
     MODEL = None
 
+# ------------- Startup warmup -------------
+@app.on_event("startup")
+async def warm():
+    # load MiniLM + HNSW segment now instead of on the first /ask
+    try:
+        collection.query(query_embeddings=embed_texts(["warmup"]).tolist(), n_results=1)
+        get_metadata_snapshot()
+    except Exception:
+        pass
+
 # ------------- Request/Response models -------------
 class AskRequest(BaseModel):
     question: str
@@ -65,10 +75,6 @@ class AskRequest(BaseModel):
     return_docs: bool = True
 
 # ------------- utilities -------------
-def normalize_score(distance: float) -> float:
-    # convert distance -> similarity; for display only
-    return round(1 / (1 + distance), 4)
-
 def build_context_from_results(results: Dict[str, Any], max_chars_total=MAX_TOTAL_CONTEXT_CHARS):
     """
     Build an ordered context string from chroma query results.
@@ -77,37 +83,189 @@ def build_context_from_results(results: Dict[str, Any], max_chars_total=MAX_TOTA
     docs = results["documents"][0]
     ids = results["ids"][0]
     dists = results.get("distances", [[]])[0]
-    metas = results["metadatas"][0]
+    metas = [m or {} for m in results["metadatas"][0]]
 
     context_parts = []
-    provenance = []
     total_chars = 0
 
-    for i, doc_text in enumerate(docs):
+    for doc_id, doc_text, meta in zip(ids, docs, metas):
         if total_chars >= max_chars_total:
             break
-        doc_id = ids[i]
-        meta = metas[i] or {}
         # choose snippet: cleaned_text was indexed; we can take first N chars
-        snippet = (doc_text or "").strip().replace("\n", " ")
-        snippet = snippet[:MAX_CONTEXT_CHARS_PER_DOC]
-        header = f"---DOC ID: {doc_id} | patient: {meta.get('patient_name') or meta.get('patient') or 'unknown'} | date: {meta.get('date') or meta.get('source_file') }---\n"
-        block = header + snippet + "\n"
+        # (slice before replace so long notes aren't scanned end to end)
+        # slice before lstrip so only a bounded prefix of a long doc is copied;
+        # the slack covers leading whitespace
+        snippet = (doc_text or "")[:MAX_CONTEXT_CHARS_PER_DOC + 128].lstrip()[:MAX_CONTEXT_CHARS_PER_DOC]
+        snippet = snippet.replace("\n", " ").rstrip()
+        patient = meta.get("patient_name") or meta.get("patient") or "unknown"
+        date = meta.get("date") or meta.get("source_file")
+        block = "".join((f"---DOC ID: {doc_id} | patient: {patient} | date: {date}---\n", snippet, "\n"))
         context_parts.append(block)
         total_chars += len(block)
-        provenance.append({
-            "id": doc_id,
-            "patient": meta.get("patient_name"),
-            "doctor": meta.get("doctor"),
-            "diagnosis": meta.get("diagnosis"),
-            "score": normalize_score(dists[i]) if dists else None,
-        })
+
+    # provenance for exactly the docs that made it into the context
+    used = len(context_parts)
+    provenance = [
+        {
+            "id": ids[i],
+            "patient": metas[i].get("patient_name"),
+            "doctor": metas[i].get("doctor"),
+            "diagnosis": metas[i].get("diagnosis"),
+            "score": round(1 - dists[i], 4) if dists else None,  # cosine similarity
+        }
+        for i in range(used)
+    ]
 
     context_text = "\n".join(context_parts)
     return context_text, provenance
 
+# ------------- Metadata analytics (no LLM call) -------------
+_TREATMENT_WORD = r"(?:treatment|medication|medicine|drug|prescription)s?"
+_VERB = r"(?:is|was|are|were|has\s+been|have\s+been)"
+_GIVEN = r"(?:prescribed|given|used)"
+# Only optional punctuation may follow: a trailing "for diabetes patients",
+# "to Rohaan Khan", ... is a qualified question → leave it to RAG
+_END = r"\s*[?.!]*$"
+
+# One named group per intent, joined into a single alternation so every
+# question is scanned once. Each branch is ^-anchored, so under leftmost-first
+# matching the branches are tried in list order → earlier intents win.
+INTENT_PATTERNS = [
+    # "Which patients had / have been diagnosed with / were diagnosed with X (diagnosis)?"
+    ("diagnosis_query",
+        r"^which\s+patients?\s+(?:(?:have|had)\s+been\s+|were\s+|are\s+)?"
+        r"(?:diagnosed\s+with|had|have|with)\s+(?:(?:a|an|the)\s+)?(?:diagnosis\s+of\s+)?"
+        r"(?P<diagnosis>[^?]+?)(?:\s+diagnosis)?\s*\??$"),
+    # Whole-question forms only:
+    # "What (treatment) was prescribed (the) most (frequently)?"
+    # "What is the most common (prescribed) treatment?"
+    # "Which drug was most commonly prescribed?"
+    ("treatment_frequency",
+        r"^(?:what|which)(?:\s+" + _TREATMENT_WORD + r")?\s+" + _VERB + r"\s+" + _GIVEN +
+        r"\s+(?:the\s+)?most(?:\s+(?:frequently|commonly|often))?" + _END +
+        r"|^(?:what|which)\s+" + _VERB + r"\s+(?:the\s+)?most\s+(?:frequent(?:ly)?|common(?:ly)?)\s+(?:" + _GIVEN + r"\s+)?" + _TREATMENT_WORD + _END +
+        r"|^(?:what|which)\s+" + _TREATMENT_WORD + r"\s+" + _VERB + r"\s+most\s+(?:frequently|commonly|often)\s+" + _GIVEN + _END),
+]
+INTENT = intent_re.compile(
+    "(?i)" + "|".join(f"(?P<{name}>{pattern})" for name, pattern in INTENT_PATTERNS)
+)
+
+
+def detect_intent(question: str):
+    """Return (intent, match) for the matching intent, else (None, None)."""
+    m = INTENT.search(question)
+    if m:
+        for name, _ in INTENT_PATTERNS:
+            if m.group(name) is not None:
+                return name, m
+    return None, None
+
+# (ids, metadatas) snapshot for diagnosis lookups; reset by /upload.
+# The generation counter lets a rebuild notice an invalidation that happened
+# while its collection.get() was in flight.
+_METADATA_CACHE = None
+_METADATA_GENERATION = 0
+_METADATA_LOCK = threading.Lock()
+
+
+def get_metadata_snapshot():
+    global _METADATA_CACHE
+    with _METADATA_LOCK:
+        if _METADATA_CACHE is not None:
+            return _METADATA_CACHE
+        generation = _METADATA_GENERATION
+
+    # slow read happens outside the lock
+    res = collection.get(include=["metadatas"])
+    snapshot = (res["ids"], [m or {} for m in res["metadatas"]])
+
+    with _METADATA_LOCK:
+        # only cache it if no /upload invalidated the cache in the meantime
+        if generation == _METADATA_GENERATION:
+            _METADATA_CACHE = snapshot
+    return snapshot
+
+
+def invalidate_metadata_cache():
+    global _METADATA_CACHE, _METADATA_GENERATION
+    with _METADATA_LOCK:
+        _METADATA_GENERATION += 1
+        _METADATA_CACHE = None
+
+
+def meta_provenance(doc_id: str, meta: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": doc_id,
+        "patient": meta.get("patient_name"),
+        "doctor": meta.get("doctor"),
+        "diagnosis": meta.get("diagnosis"),
+        "score": None,
+    }
+
+
+# a captured "diagnosis" containing one of these is really a longer clinical
+# question ("patients with diabetes were prescribed metformin") → leave it to RAG
+_NOT_A_DIAGNOSIS = re.compile(
+    r"\b(?:was|were|is|are|got|get|received?|prescribed|given|taking|treated|and|or)\b", re.I
+)
+
+
+def answer_diagnosis_query(diagnosis: str) -> Dict[str, Any] | None:
+    """
+    Patients whose metadata.diagnosis contains `diagnosis` (case-insensitive).
+    Returns None when the term doesn't look like a diagnosis or nothing matches,
+    so /ask falls back to normal retrieval + Gemini.
+    """
+    needle = diagnosis.strip().lower()
+    if not needle or _NOT_A_DIAGNOSIS.search(needle):
+        return None
+
+    ids, metas = get_metadata_snapshot()
+    prov = [
+        meta_provenance(doc_id, meta)
+        for doc_id, meta in zip(ids, metas)
+        if needle in (meta.get("diagnosis") or "").lower()
+    ]
+    patients = list(dict.fromkeys(p["patient"] for p in prov if p["patient"]))
+    if not patients:
+        return None
+
+    return {
+        "answer": ", ".join(patients),
+        "type": "diagnosis_query",
+        "patients": patients,
+        "treatment_stats": {},
+        "used_documents": [p["id"] for p in prov],
+        "provenance": prov,
+        "confidence": "high",
+    }
+
+
+def answer_treatment_frequency() -> Dict[str, Any] | None:
+    """Most common canonical prescription across all indexed notes (None if no data)."""
+    # counts are aggregated at ingest time by chroma_index.py
+    sidecar = current_treatment_counts()
+    counts = Counter(sidecar["counts"])
+    if not counts:
+        return None
+
+    treatment, count = counts.most_common(1)[0]
+    doc_ids = [doc_id for doc_id, ts in sidecar["docs"].items() if treatment in ts]
+    res = collection.get(ids=doc_ids, include=["metadatas"])
+    prov = [meta_provenance(doc_id, meta or {}) for doc_id, meta in zip(res["ids"], res["metadatas"])]
+
+    return {
+        "answer": f"{treatment} (prescribed {count} times)",
+        "type": "treatment_frequency",
+        "patients": [],
+        "treatment_stats": {"treatment": treatment, "count": count},
+        "used_documents": [p["id"] for p in prov],
+        "provenance": prov,
+        "confidence": "high",
+    }
+
 # ------------- Core function: get answer via Gemini -------------
-def answer_with_gemini(question: str, context_text: str, provenance: List[Dict], max_response_chars: int = 2000):
+async def answer_with_gemini(question: str, context_text: str, provenance: List[Dict], max_response_chars: int = 2000):
     if MODEL is None:
         raise RuntimeError("Gemini client not configured")
 
@@ -198,7 +356,8 @@ def answer_with_gemini(question: str, context_text: str, provenance: List[Dict],
 
 
     try:
-        response = MODEL.generate_content(system + "\n\n" + user_prompt)
+        # async variant keeps the event loop free while Gemini responds
+        response = await MODEL.generate_content_async(system + "\n\n" + user_prompt)
         raw = response.text
         # remove fences if any
         clean = raw.replace("```json", "").replace("```", "").strip()
@@ -208,15 +367,30 @@ def answer_with_gemini(question: str, context_text: str, provenance: List[Dict],
 
 # ------------- API Endpoint -------------
 @app.post("/ask")
-def ask(req: AskRequest):
+async def ask(req: AskRequest):
     q = req.question
     top_k = min(max(1, req.top_k), 10)
 
+    # 0) analytics questions are answered straight from Chroma metadata;
+    #    no confident metadata answer → fall through to retrieval + Gemini
+    try:
+        analytics = None
+        intent, m = detect_intent(q.strip())
+        if intent == "diagnosis_query":
+            analytics = await run_in_threadpool(answer_diagnosis_query, m.group("diagnosis"))
+        elif intent == "treatment_frequency":
+            analytics = await run_in_threadpool(answer_treatment_frequency)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Chroma metadata error: {e}")
+    if analytics is not None:
+        return analytics
 
-    # 1) retrieve from Chroma
+    # 1) retrieve from Chroma (embedding + HNSW search are blocking → threadpool)
     try:
-        results = collection.query(
-            query_texts=[q],
+        query_embeddings = (await run_in_threadpool(embed_texts, [q])).tolist()
+        results = await run_in_threadpool(
+            collection.query,
+            query_embeddings=query_embeddings,
             n_results=top_k,
             include=["documents", "metadatas", "distances"]
         )
@@ -228,7 +402,7 @@ def ask(req: AskRequest):
 
     context_text, prov = build_context_from_results(results)
     # 2) call Gemini with context
-    model_output = answer_with_gemini(q, context_text, prov)
+    model_output = await answer_with_gemini(q, context_text, prov)
 
     # 3) try to parse JSON
 # Parse model output
@@ -266,22 +440,13 @@ async def upload_file(file: UploadFile = File(...)):
         with open(save_path, "wb") as f:
             f.write(await file.read())
 
-        # 2. Run your Gemini OCR → JSON generator script
-        # This will save JSON into outputs/clean/
-        import sys
+        # 2. Run Gemini OCR → JSON generator (saves JSON into outputs/clean/)
+        json_paths = await run_in_threadpool(process_path, str(save_path))
 
-        subprocess.run(
-            [sys.executable, "gemini_ocr_improve.py", str(save_path)],
-            check=True
-        )
-        # 3. Re-index Chroma so RAG can use new document
-        subprocess.run(
-            [sys.executable, "chroma_index.py"],
-            check=True
-        )
-        
-        
-        
+        # 3. Index only the new document so RAG can use it
+        for json_path in json_paths:
+            await run_in_threadpool(index_file, json_path)
+        invalidate_metadata_cache()
 
         return {
             "status": "success",
@@ -5,6 +5,17 @@ import base64
 
 FASTAPI_URL = "http://localhost:8001"
 
+
+# One keep-alive session per Streamlit server, reused across reruns
+@st.cache_resource
+def get_session():
+    session = requests.Session()
+    session.headers.update({"Connection": "keep-alive"})
+    return session
+
+
+SESSION = get_session()
+
 st.set_page_config(page_title="Medical RAG Assistant", layout="wide")
 
 st.title("💊 Medical RAG Assistant")
@@ -29,7 +40,7 @@ if uploaded_file:
             files = {"file": (uploaded_file.name, uploaded_file, uploaded_file.type)}
 
             try:
-                resp = requests.post(f"{FASTAPI_URL}/upload", files=files)
+                resp = SESSION.post(f"{FASTAPI_URL}/upload", files=files)
 
                 if resp.status_code == 200:
                     data = resp.json()
@@ -56,7 +67,7 @@ if st.button("Ask"):
     else:
         with st.spinner("Thinking…"):
             try:
-                resp = requests.post(f"{FASTAPI_URL}/ask", json={"question": query})
+                resp = SESSION.post(f"{FASTAPI_URL}/ask", json={"question": query})
                 data = resp.json()
 
                 if "answer" in data: